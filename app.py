@@ -1,26 +1,372 @@
+import atexit
+import collections
+import functools
+import hashlib
+import itertools
 import os
 import re
+import numpy as np
 import streamlit as st
 import zipfile
 from PIL import Image
 import io
 import math
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# ---------- Page Geometry ----------
+# Collage pages are rendered for an A4 sheet at this resolution; larger
+# images are downscaled to their grid cell before being pasted.
+PAGE_DPI = 150
+A4_SIZE_INCHES = (8.27, 11.69)
+PAGE_SIZE = (int(A4_SIZE_INCHES[0] * PAGE_DPI), int(A4_SIZE_INCHES[1] * PAGE_DPI))
+# Pillow stores RGB PDF pages as JPEG (DCTDecode); this is the encoder quality
+PDF_JPEG_QUALITY = 85
 
 # ---------- Helper Functions ----------
 
+IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png", "bmp", "gif", "tiff"})
+
+def is_image_file(filename):
+    """True if `filename` has one of the supported image extensions (case-insensitive)."""
+    _, dot, ext = filename.rpartition(".")
+    return bool(dot) and ext.lower() in IMAGE_EXTENSIONS
+
+DIGIT_RUNS = re.compile(r'\d+')
+
+def encode_digit_run(match):
+    """Encode a run of digits as "\\x01" + chr(length) + digits, so numbers compare by value."""
+    digits = str(int(match.group()))
+    return "\x01" + chr(len(digits)) + digits
+
 def alphanumeric_key(filename):
     """
-    Convert filename into a list of string and integer chunks for "natural" sorting.
-    E.g. "10.png" -> ['','10',''] + ['.png'] -> [ '', 10, '' , '.png' ].
+    Convert filename into a single string for "natural" sorting.
+    Digit runs are length-prefixed (see `encode_digit_run`) and the extension
+    follows a "\\x00" separator, so plain string comparison, done in C, gives
+    the natural order without building a list of str/int chunks per name.
+    E.g. "Page10.PNG" -> "page\\x01\\x0210\\x00.png".
     """
-    base, ext = os.path.splitext(filename)
-    parts = re.split(r'(\d+)', base)
-    return [int(p) if p.isdigit() else p.lower() for p in parts] + [ext.lower()]
+    base, ext = os.path.splitext(filename.lower())
+    return DIGIT_RUNS.sub(encode_digit_run, base) + "\x00" + ext
 
 def chunker(seq, size):
-    """Yield successive chunks of length `size` from `seq`."""
-    for pos in range(0, len(seq), size):
-        yield seq[pos:pos + size]
+    """Yield successive lists of length `size` from the iterable `seq`."""
+    it = iter(seq)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+def prefetch(futures, depth):
+    """
+    Yield the results of `futures` in order, pulling at most `depth` of them
+    ahead of the consumer. With a lazy iterator that submits work as it is
+    pulled, this bounds how much work is in flight at any time.
+    """
+    pending = collections.deque()
+    for future in futures:
+        pending.append(future)
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def page_grid(n_images):
+    """
+    Return `(cols, rows, cell_size)` for a page of `n_images`: a square-ish
+    grid, and the share of PAGE_SIZE each image is fitted into.
+    """
+    cols = int(math.ceil(math.sqrt(n_images)))
+    rows = int(math.ceil(n_images / cols))
+    return cols, rows, (PAGE_SIZE[0] // cols, PAGE_SIZE[1] // rows)
+
+def fitted_size(size, cell_size):
+    """Return `size` scaled down to fit within `cell_size`, keeping its aspect ratio."""
+    width, height = size
+    scale = min(cell_size[0] / width, cell_size[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def decode_image(zip_ref, info, cell_size=None):
+    """
+    Decode the ZIP entry `info` into an RGB PIL image, streaming it from the
+    archive without materializing the encoded bytes. Given the `cell_size`
+    the image will be fitted into, JPEGs are decoded at a reduced scale (1/2,
+    1/4 or 1/8) that is still at least as large as the fitted size, and the
+    result is fitted to the cell here, so all per-image pixel work happens
+    on the calling (worker) thread.
+    """
+    with zip_ref.open(info) as file:
+        img = Image.open(file)
+        # Multi-picture JPEGs (MPO, common from phone cameras) are JPEGs too
+        if cell_size is not None and img.format in ("JPEG", "MPO"):
+            # Must happen before load(): libjpeg does the scaling during the DCT
+            img.draft("RGB", fitted_size(img.size, cell_size))
+        # Force the decode here, before the entry is closed: Pillow is lazy, and
+        # its codecs release the GIL, so this is what actually runs in parallel
+        # on the worker threads.
+        img.load()
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if cell_size is not None:
+        img = fit_to_cell(img, cell_size)
+    return img
+
+def content_digest(zip_ref, info):
+    """blake2b digest of the contents of the ZIP entry `info`."""
+    return hashlib.blake2b(zip_ref.read(info), digest_size=16).digest()
+
+def duplicate_digests(executor, zip_ref, infos):
+    """
+    Return `{info: digest}` for the entries of `infos` whose contents appear
+    more than once. Keyed by ZipInfo rather than name, since an archive may
+    hold several entries under the same name. Candidates are matched on the
+    CRC-32 and size in the ZIP directory, so only they are read and hashed
+    (on `executor`).
+    """
+    candidates = collections.defaultdict(list)
+    for info in infos:
+        candidates[info.CRC, info.file_size].append(info)
+
+    to_hash = [info for same_crc in candidates.values() if len(same_crc) > 1 for info in same_crc]
+    hashed = executor.map(functools.partial(content_digest, zip_ref), to_hash)
+    return dict(zip(to_hash, hashed))
+
+def submit_decodes(executor, zip_ref, planned, digests):
+    """
+    Submit `decode_image` for each `(info, cell_size)` of `planned` and yield
+    its Future, lazily and in order. Entries listed in `digests` share one
+    Future per digest and cell size, so duplicated contents are decoded once;
+    a shared Future is dropped after its last use, so it holds the image
+    only while copies of it are still to come.
+    """
+    remaining = collections.Counter(
+        (digests[info], cell_size)
+        for info, cell_size in planned
+        if info in digests
+    )
+    shared = {}
+    for info, cell_size in planned:
+        digest = digests.get(info)
+        if digest is None:
+            yield executor.submit(decode_image, zip_ref, info, cell_size)
+            continue
+
+        key = (digest, cell_size)
+        future = shared.get(key)
+        if future is None:
+            future = shared[key] = executor.submit(decode_image, zip_ref, info, cell_size)
+        remaining[key] -= 1
+        if not remaining[key]:
+            del shared[key]
+        yield future
+
+def fit_to_cell(img, cell_size):
+    """Downscale `img` to fit within `cell_size`, keeping its aspect ratio. Never upscales."""
+    new_size = fitted_size(img.size, cell_size)
+    if new_size == img.size:
+        return img
+    # reducing_gap: shrink by an integer factor with a fast box reduce first,
+    # leaving LANCZOS at least 3x the target size to work from
+    return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+def make_uniform_collage(images, cols, rows):
+    """
+    Collage for images that all share one size (e.g. scanned pages). The page
+    is filled row by row through a (rows, height, cols, width, 3) view of the
+    canvas, so there are no per-tile offsets and only the empty cells at the
+    end of the last row are painted white.
+    """
+    width, height = images[0].size
+    grid = np.empty((rows, height, cols, width, 3), dtype=np.uint8)
+    for row, row_images in enumerate(chunker(images, cols)):
+        n_in_row = len(row_images)
+        np.stack([np.asarray(img) for img in row_images], axis=1, out=grid[row, :, :n_in_row])
+        grid[row, :, n_in_row:] = 255
+    return Image.fromarray(grid.reshape(rows * height, cols * width, 3))
+
+def make_collage(images):
+    """Paste `images` into a square-ish grid on a white page and return it."""
+    # Decide how many columns/rows in the grid
+    cols, rows, cell_size = page_grid(len(images))
+
+    # Shrink each image to its share of the page; the PDF doesn't need more.
+    # A no-op for images decode_image() already fitted to this cell size.
+    images = [fit_to_cell(img, cell_size) for img in images]
+
+    # One pass over the images collects their distinct sizes, which is
+    # enough both to spot a uniform page and to find the max width/height
+    sizes = {img.size for img in images}
+    if len(sizes) == 1:
+        return make_uniform_collage(images, cols, rows)
+
+    max_width = max(width for width, _ in sizes)
+    max_height = max(height for _, height in sizes)
+
+    # Create the collage canvas uninitialized; only what no image covers is
+    # painted white, instead of filling the whole page first
+    collage_width = cols * max_width
+    collage_height = rows * max_height
+    canvas = np.empty((collage_height, collage_width, 3), dtype=np.uint8)
+
+    # Copy each image into the collage grid, row-major; one slice assignment
+    # per tile, with the cell offsets laid out up front for the grid shape
+    cell_offsets = itertools.product(
+        range(0, collage_height, max_height),
+        range(0, collage_width, max_width)
+    )
+    for img, (y_offset, x_offset) in zip(images, cell_offsets):
+        cell = canvas[y_offset:y_offset + max_height, x_offset:x_offset + max_width]
+        cell[:img.height, :img.width] = np.asarray(img)
+        cell[:img.height, img.width:] = 255
+        cell[img.height:] = 255
+
+    # Empty cells at the end of the last row
+    n_in_last_row = len(images) - (rows - 1) * cols
+    canvas[(rows - 1) * max_height:, n_in_last_row * max_width:] = 255
+
+    return Image.fromarray(canvas)
+
+def collage_pages(images, images_per_page):
+    """
+    Yield one collage page per `images_per_page` images from the iterator
+    `images`. Each group is released as soon as its page is built, so only
+    one page's worth of decoded images (plus whatever is being prefetched)
+    is alive at a time.
+    """
+    while True:
+        group = list(itertools.islice(images, images_per_page))
+        if not group:
+            return
+        page = make_collage(group)
+        # Drop this page's images before waiting on the next group's decodes
+        del group
+        yield page
+
+def write_file_list(files, limit=200):
+    """Write at most `limit` file names to the page, noting how many were left out."""
+    st.write(files[:limit])
+    if len(files) > limit:
+        st.caption(f"...{len(files) - limit} more hidden")
+
+# ---------- Cached Processing ----------
+# Streamlit reruns the whole script on every widget interaction, so the ZIP
+# reading and the PDF rendering are memoized on the uploaded bytes.
+
+@st.cache_resource
+def pdf_output_dir():
+    """Directory the generated PDFs are written to, removed when the server exits."""
+    output_dir = tempfile.TemporaryDirectory(prefix="combined_pdfs_")
+    atexit.register(output_dir.cleanup)
+    return output_dir
+
+def pdf_path_for(zip_bytes, images_per_page):
+    """
+    Path of the PDF for these inputs. It is derived from the inputs, so a
+    rebuild overwrites the previous file instead of adding another one.
+    """
+    digest = hashlib.blake2b(zip_bytes, digest_size=16).hexdigest()
+    return os.path.join(pdf_output_dir().name, f"{digest}_{images_per_page}.pdf")
+
+def prune_pdfs(output_dir, keep=8):
+    """Delete all but the `keep` most recently written PDFs in `output_dir`."""
+    pdfs = []
+    for entry in os.scandir(output_dir):
+        if entry.name.endswith(".pdf"):
+            try:
+                pdfs.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    pdfs.sort(reverse=True)
+    for _, path in pdfs[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def image_infos(zip_ref):
+    """Return the ZipInfo of every valid image entry of `zip_ref`, in natural order."""
+    # Keep only valid image files, holding on to their ZipInfo so reading
+    # them doesn't need a name -> ZipInfo lookup
+    infos = [
+        info for info in zip_ref.infolist()
+        if not info.is_dir() and is_image_file(info.filename)
+    ]
+
+    # Sort with natural key
+    infos.sort(key=lambda info: alphanumeric_key(info.filename))
+    return infos
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def list_images(zip_bytes):
+    """
+    Read a ZIP archive's directory and return `(all_files, image_files)`:
+    every entry name, and the valid image names in natural order.
+    """
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zip_ref:
+        all_files = zip_ref.namelist()
+        image_files = [info.filename for info in image_infos(zip_ref)]
+    return all_files, image_files
+
+def write_pdf(zip_bytes, images_per_page, pdf_path):
+    """Lay out the images of the ZIP `images_per_page` to a page and write the PDF to `pdf_path`."""
+    workers = os.cpu_count() or 1
+
+    # The executor is entered last so its threads finish before the archive closes
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zip_ref, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        infos = image_infos(zip_ref)
+
+        # Repeated images (cover pages, thumbnails) are decoded once per cell size
+        digests = duplicate_digests(executor, zip_ref, infos)
+
+        # Each decode knows the grid cell its image will be fitted into
+        planned = [
+            (info, page_grid(len(group))[2])
+            for group in chunker(infos, images_per_page)
+            for info in group
+        ]
+
+        # Decode lazily, a bounded window ahead of the page being built, so
+        # each decoded image can be dropped as soon as it has been pasted
+        images = prefetch(submit_decodes(executor, zip_ref, planned, digests), workers)
+
+        # One collage page per group of "images_per_page"
+        pages = collage_pages(images, images_per_page)
+
+        # Written under a temporary name and moved into place once complete, so
+        # a failed build leaves nothing behind and readers never see a partial file
+        pdf_file = tempfile.NamedTemporaryFile(
+            suffix=".part", dir=os.path.dirname(pdf_path), delete=False
+        )
+        try:
+            with pdf_file:
+                first_page = next(pages)
+                first_page.save(
+                    pdf_file,
+                    format="PDF",
+                    save_all=True,
+                    append_images=pages,
+                    quality=PDF_JPEG_QUALITY,
+                    optimize=True,
+                    dpi=(PAGE_DPI, PAGE_DPI),
+                    # Pillow would otherwise title the document after the file name
+                    title=f"{images_per_page}_per_page"
+                )
+            os.replace(pdf_file.name, pdf_path)
+        except BaseException:
+            os.remove(pdf_file.name)
+            raise
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def build_pdf(zip_bytes, images_per_page):
+    """
+    Build the PDF for the ZIP with `images_per_page` images to a page and
+    return its path. The document lives on disk, so the cache holds a path
+    rather than a copy of the whole PDF; only the most recent few are kept.
+    """
+    pdf_path = pdf_path_for(zip_bytes, images_per_page)
+    write_pdf(zip_bytes, images_per_page, pdf_path)
+    prune_pdfs(os.path.dirname(pdf_path))
+    return pdf_path
 
 # ---------- Main App Function ----------
 def main():
@@ -94,98 +440,45 @@ def main():
     # ---- File Uploader ----
     uploaded_zip = st.file_uploader("Upload a ZIP containing images", type=["zip"])
     if uploaded_zip is not None:
+        zip_bytes = uploaded_zip.getvalue()
         try:
-            with zipfile.ZipFile(uploaded_zip, "r") as zip_ref:
-                valid_extensions = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff")
-
-                # Raw list of files from ZIP
-                all_files = zip_ref.namelist()
-
-                # Keep only valid image files
-                image_files = [
-                    f for f in all_files
-                    if f.lower().endswith(valid_extensions)
-                ]
-
-                # Sort with natural key
-                image_files.sort(key=alphanumeric_key)
-
-                # Visualization: Show file lists in an expander
-                with st.expander("Preview: ZIP File Contents"):
-                    st.write("**All Files (unsorted):**")
-                    st.write(all_files)
-                    st.write("**Valid Image Files (sorted):**")
-                    st.write(image_files)
-
-                if not image_files:
-                    st.warning("No valid image files found in the ZIP.")
-                    return
-
-                # Read the images into a list
-                images_list = []
-                for image_file in image_files:
-                    with zip_ref.open(image_file) as file:
-                        img_data = file.read()
-                    img = Image.open(io.BytesIO(img_data))
-                    # Convert RGBA/P modes to RGB
-                    if img.mode in ("RGBA", "P"):
-                        img = img.convert("RGB")
-                    images_list.append(img)
-
-                # ----- Create Collage Pages -----
-                collage_pages = []
-
-                # For each group of "images_per_page"
-                for group_of_n in chunker(images_list, images_per_page):
-                    n_in_this_chunk = len(group_of_n)
-
-                    # For this chunk, decide how many columns/rows in the grid
-                    # We'll aim for a square-ish layout:
-                    cols = int(math.ceil(math.sqrt(n_in_this_chunk)))
-                    rows = int(math.ceil(n_in_this_chunk / cols))
-
-                    # Determine the max width/height for images in this chunk
-                    max_width = max(img.width for img in group_of_n)
-                    max_height = max(img.height for img in group_of_n)
-
-                    # Create a blank collage image
-                    collage_width = cols * max_width
-                    collage_height = rows * max_height
-                    collage = Image.new("RGB", (collage_width, collage_height), "white")
-
-                    # Paste each image into the collage grid
-                    for i, img in enumerate(group_of_n):
-                        row = i // cols
-                        col = i % cols
-                        x_offset = col * max_width
-                        y_offset = row * max_height
-                        collage.paste(img, (x_offset, y_offset))
-
-                    collage_pages.append(collage)
-
-                # ----- Create the PDF -----
-                pdf_buffer = io.BytesIO()
-                if collage_pages:
-                    collage_pages[0].save(
-                        pdf_buffer,
-                        format="PDF",
-                        save_all=True,
-                        append_images=collage_pages[1:]
-                    )
-                    pdf_buffer.seek(0)
-
-                    st.success(f"PDF created successfully with {images_per_page} image(s) per page!")
-                    st.download_button(
-                        label="Download PDF",
-                        data=pdf_buffer,
-                        file_name=f"{images_per_page}_per_page.pdf",
-                        mime="application/pdf"
-                    )
-                else:
-                    st.warning("No collage pages were created.")
+            all_files, image_files = list_images(zip_bytes)
+        except zipfile.BadZipFile:
+            st.error("The uploaded file is not a valid ZIP archive.")
+            return
 
+        # Visualization: Show file lists in an expander. Its contents are sent to
+        # the browser even while collapsed, so long lists are truncated.
+        with st.expander(f"Preview: ZIP File Contents ({len(all_files)} files)"):
+            st.write("**All Files (unsorted):**")
+            write_file_list(all_files)
+            st.write("**Valid Image Files (sorted):**")
+            write_file_list(image_files)
+
+        if not image_files:
+            st.warning("No valid image files found in the ZIP.")
+            return
+
+        # ----- Create the PDF -----
+        # Entries are only read here, so a corrupt entry (bad CRC, truncated
+        # data) surfaces from build_pdf rather than from list_images
+        try:
+            pdf_path = build_pdf(zip_bytes, images_per_page)
+            # The cached path may point at a PDF pruned since; write it again
+            if not os.path.exists(pdf_path):
+                write_pdf(zip_bytes, images_per_page, pdf_path)
         except zipfile.BadZipFile:
             st.error("The uploaded file is not a valid ZIP archive.")
+            return
+
+        st.success(f"PDF created successfully with {images_per_page} image(s) per page!")
+        with open(pdf_path, "rb") as pdf_file:
+            st.download_button(
+                label="Download PDF",
+                data=pdf_file,
+                file_name=f"{images_per_page}_per_page.pdf",
+                mime="application/pdf"
+            )
 
 # ---------- Run the App ----------
 if __name__ == "__main__":